@@ -3,22 +3,39 @@ import subprocess
 import json
 import time
 import re
-from pathlib import Path
+import queue
+import threading
+from collections import deque
+from functools import lru_cache
+
+# Precompiled patterns for log parsing
+_CLEAN_RE = re.compile(r"Clean datasets collected: (\d+)/(\d+)")
+_TS_RE = re.compile(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - (\w+) - (.+)')
+_EVENT_RE = re.compile(
+    r'(?P<start>Starting download process for term:)'
+    r'|(?P<search>Searching SRA database)'
+    r'|(?P<info>Run info list:)'
+    r'|(?P<download>Downloading (?P<dl_fn>.+\.fastq\.gz))'
+    r'|(?P<analysis>Running FastQC:)'
+    r'|(?P<fail>FastQC found quality issues)'
+    r'|(?P<pass>File passed quality check)'
+    r'|(?P<progress>Clean datasets collected: (?P<current>\d+)/(?P<target>\d+))'
+    r'|(?P<complete>Process completed)'
+)
 
 def parse_log_line(line):
     """Parse log lines to extract metrics"""
     if "Clean datasets collected:" in line:
-        match = re.search(r"Clean datasets collected: (\d+)/(\d+)", line)
+        match = _CLEAN_RE.search(line)
         if match:
             return int(match.group(1)), int(match.group(2))
     return None
 
-def get_current_log_file():
-    """Get the most recent log file"""
-    log_files = list(Path('.').glob('sra_downloader_*.log'))
-    if log_files:
-        return max(log_files, key=lambda x: x.stat().st_mtime)
-    return None
+def enqueue_output(stream, output_queue):
+    """Push each line of the subprocess output onto the queue"""
+    for line in iter(stream.readline, ''):
+        output_queue.put(line.rstrip('\n'))
+    stream.close()
 
 def create_metrics_container():
     """Create and return containers for metrics"""
@@ -86,39 +103,35 @@ def create_status_area():
         
     return status_container, events_container
 
+# Formatter for each named group of _EVENT_RE, returning (status message, status type)
+_STATUS_HANDLERS = {
+    'start': lambda m: (f"🚀 Starting download process...\n {m.string}", "start"),
+    'search': lambda m: (f"🔍 Searching SRA database...\n {m.string}", "search"),
+    'info': lambda m: ("📋 Retrieved dataset information", "info"),
+    'download': lambda m: (f"⬇️ Downloading {m.group('dl_fn')}", "download"),
+    'analysis': lambda m: ("🔬 Running quality check...", "analysis"),
+    'fail': lambda m: ("❌ Dataset failed quality check", "fail"),
+    'pass': lambda m: ("✅ Dataset passed quality check", "pass"),
+    'progress': lambda m: (f"📊 Progress: {m.group('current')}/{m.group('target')} clean datasets", "progress"),
+    'complete': lambda m: ("✨ Process completed", "complete"),
+}
+
+@lru_cache(maxsize=2048)
+def _status_from_message(message):
+    """Format the status for a log message with its timestamp already stripped"""
+    match = _EVENT_RE.search(message)
+    return _STATUS_HANDLERS[match.lastgroup](match) if match else (None, None)
+
 def parse_status_from_log(line):
     """Parse a log line and return a formatted status message"""
-    # Extract timestamp if present
-    timestamp_match = re.match(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - (\w+) - (.+)', line)
+    # Extract timestamp if present, so identical messages share a cache entry
+    timestamp_match = _TS_RE.match(line)
     if timestamp_match:
         message = timestamp_match.group(3)
     else:
         message = line
 
-    if "Starting download process for term:" in message:
-        return f"🚀 Starting download process...\n {message}", "start"
-    elif "Searching SRA database" in message:
-        return f"🔍 Searching SRA database...\n {message}", "search"
-    elif "Run info list:" in message:
-        return "📋 Retrieved dataset information", "info"
-    elif "Downloading" in message and ".fastq.gz" in message:
-        match = re.search(r'Downloading (.+\.fastq\.gz)', message)
-        filename = match.group(1) if match else "dataset"
-        return f"⬇️ Downloading {filename}", "download"
-    elif "Running FastQC:" in message:
-        return "🔬 Running quality check...", "analysis"
-    elif "FastQC found quality issues" in message:
-        return "❌ Dataset failed quality check", "fail"
-    elif "File passed quality check" in message:
-        return "✅ Dataset passed quality check", "pass"
-    elif "Clean datasets collected:" in message:
-        match = re.search(r"Clean datasets collected: (\d+)/(\d+)", message)
-        if match:
-            current, target = match.groups()
-            return f"📊 Progress: {current}/{target} clean datasets", "progress"
-    elif "Process completed" in message:
-        return "✨ Process completed", "complete"
-    return None, None
+    return _status_from_message(message)
 
 def main():
     st.set_page_config(
@@ -195,92 +208,119 @@ def main():
     )
     progress_bar = st.progress(0)
     
-    # Initialize event log
-    recent_events = []
+    # Initialize event log of (event, status_type) pairs
     max_events = 5  # Number of recent events to show
+    recent_events = deque(maxlen=max_events)
     
     # Start the download process
-    command = f"python3 sra_downloader.py --term '{term}' --num_datasets {num_datasets} --workers {num_workers}"
+    log_file = f"sra_downloader_{time.strftime('%Y%m%d_%H%M%S')}.log"
+    command = f"python3 sra_downloader.py --term '{term}' --num_datasets {num_datasets} --workers {num_workers} --log_file '{log_file}' --no_progress"
     process = subprocess.Popen(
         command,
         shell=True,
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
         universal_newlines=True,
         bufsize=1
     )
     
+    # Read the downloader's output on a background thread so the UI never blocks
+    output_queue = queue.Queue()
+    reader = threading.Thread(
+        target=enqueue_output,
+        args=(process.stdout, output_queue),
+        daemon=True
+    )
+    reader.start()
+    st.caption(f"Full log: {log_file}")
+    
     # Initialize counters
     total_checked = 0
     current_clean = 0
     current_status = "🚀 Starting process..."
     
+    # Last values rendered, used to skip redundant UI updates
+    last_status = None
+    last_events = None
+    last_total_checked = 0
+    last_clean = None
+    
     while True:
-        log_file = get_current_log_file()
-        if log_file:
-            with open(log_file, 'r') as f:
-                log_content = f.read()
-                
-                # Update metrics and status
-                for line in log_content.split('\n'):
-                    status_msg, status_type = parse_status_from_log(line)
-                    
-                    if status_msg:
-                        current_status = status_msg
-                        # Add timestamp to events
-                        timestamp = time.strftime("%H:%M:%S")
-                        event = f"{timestamp} - {status_msg}"
-                        
-                        if event not in recent_events:
-                            recent_events.insert(0, event)
-                            recent_events = recent_events[:max_events]
-                    
-                    if "FastQC found quality issues" in line:
-                        total_checked += 1
-                    elif "File passed quality check" in line:
-                        total_checked += 1
-                        current_clean += 1
-                
-                # Update status display
-                status_container.markdown(f"""
-                ### {current_status}
-                """)
-                
-                # Update events display
-                events_html = "<div class='events-container'>"
-                for event in recent_events:
-                    # Extract status type from the event message
-                    _, status_type = parse_status_from_log(event)
-                    status_class = f"event-box {status_type}" if status_type else "event-box"
-                    events_html += f"<div class='{status_class}'>{event}</div>"
-                events_html += "</div>"
-                events_container.markdown(events_html, unsafe_allow_html=True)
-                
-                # Update progress and metrics
-                if current_clean > 0:
-                    progress = min(current_clean / num_datasets, 1.0)
-                    progress_bar.progress(progress)
-                    
-                datasets_checked.metric(
-                    label="Datasets Checked",
-                    value=str(total_checked)
-                )
-                clean_datasets.metric(
-                    label="Clean Datasets",
-                    value=f"{current_clean}/{num_datasets}"
-                )
-                if total_checked > 0:
-                    rate = (current_clean / total_checked) * 100
-                    success_rate.metric(
-                        label="Success Rate",
-                        value=f"{rate:.1f}%"
-                    )
+        # Wait for the downloader to write something, waking at least once a second
+        lines = []
+        try:
+            lines.append(output_queue.get(timeout=1.0))
+        except queue.Empty:
+            pass
         
-        # Check if process has completed
-        if process.poll() is not None:
-            break
+        # Drain anything else that arrived in the meantime
+        while True:
+            try:
+                lines.append(output_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        # Update metrics and status
+        for line in lines:
+            status_msg, status_type = parse_status_from_log(line)
+            
+            if status_msg:
+                current_status = status_msg
+                # Add timestamp to events
+                timestamp = time.strftime("%H:%M:%S")
+                event = f"{timestamp} - {status_msg}"
+                recent_events.appendleft((event, status_type))
             
-        time.sleep(1)
+            if status_type == "fail":
+                total_checked += 1
+            elif status_type == "pass":
+                total_checked += 1
+                current_clean += 1
+        
+        # Only push updates to Streamlit when something actually changed
+        if current_status != last_status:
+            status_container.markdown(f"""
+            ### {current_status}
+            """)
+            last_status = current_status
+        
+        # Update events display
+        events_snapshot = tuple(recent_events)
+        if events_snapshot != last_events:
+            events_html = "<div class='events-container'>"
+            for event, status_type in events_snapshot:
+                status_class = f"event-box {status_type}" if status_type else "event-box"
+                events_html += f"<div class='{status_class}'>{event}</div>"
+            events_html += "</div>"
+            events_container.markdown(events_html, unsafe_allow_html=True)
+            last_events = events_snapshot
+        
+        # Update progress and metrics
+        if current_clean != last_clean:
+            progress = min(current_clean / num_datasets, 1.0)
+            progress_bar.progress(progress)
+            clean_datasets.metric(
+                label="Clean Datasets",
+                value=f"{current_clean}/{num_datasets}"
+            )
+            
+        if total_checked != last_total_checked:
+            datasets_checked.metric(
+                label="Datasets Checked",
+                value=str(total_checked)
+            )
+            rate = (current_clean / total_checked) * 100
+            success_rate.metric(
+                label="Success Rate",
+                value=f"{rate:.1f}%"
+            )
+            
+        last_clean = current_clean
+        last_total_checked = total_checked
+        
+        # Check if process has completed and all of its output was consumed
+        if process.poll() is not None and not reader.is_alive() and output_queue.empty():
+            break
     
     # Final status update
     if current_clean >= num_datasets:
@@ -1,11 +1,20 @@
 import os
+import io
 import argparse
+import subprocess
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
 from dotenv import load_dotenv
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import xml.etree.ElementTree as ET
+import shutil
 from tqdm import tqdm
+from tqdm.utils import CallbackIOWrapper
 import time
 import json
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -14,14 +23,48 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Set up logging
 log_filename = f"sra_downloader_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename),
+
+_log_listener = None
+
+def setup_logging(log_file: str):
+    """
+    Send log records to the given file and the console, replacing any existing root handlers.
+    Records are queued and written by a background listener so worker threads never block on I/O.
+    The file is only created once the first record is written.
+    """
+    global _log_listener
+    stop_logging()
+    
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    handlers = [
+        logging.FileHandler(log_file, delay=True),
         logging.StreamHandler()
     ]
-)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.Queue(-1)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    
+    _log_listener = QueueListener(log_queue, *handlers)
+    _log_listener.start()
+
+def stop_logging():
+    """Flush queued log records and close the handlers of the running listener"""
+    global _log_listener
+    if _log_listener is None:
+        return
+    _log_listener.stop()
+    for handler in _log_listener.handlers:
+        handler.close()
+    _log_listener = None
+
+atexit.register(stop_logging)
 
 # Load environment variables
 env_path = os.path.join(os.path.dirname(__file__), '.env')
@@ -36,17 +79,41 @@ NCBI_TRACE_BASEURL = "https://trace.ncbi.nlm.nih.gov/Traces/sra-reads-be/fastq?a
 GZ_TEMP_FOLDER = "temp_gz_files"
 FASTQ_TEMP_FOLDER = "fastqc_temp"
 CLEAN_DATASET_FOLDER = "clean_datasets"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
 if not all([email, api_key, fastqc_path]):
     logging.error("Missing required environment variables. Please check .env file")
     raise ValueError("NCBI_EMAIL, NCBI_API_KEY, and FASTQC_PATH must be set in .env file")
 
-def get_uid_from_term(term:str,retmax:int=10,retstart:int=0) -> list[int]:
+# Shared HTTP session so connections to NCBI are pooled and reused across requests
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+))
+SESSION.headers.update({
+    'User-Agent': f'SRA Downloader (contact: {email})'
+})
+
+def redact_api_key(text: str) -> str:
+    """Mask the NCBI API key in text that may contain a request URL, e.g. an exception message"""
+    return text.replace(api_key, '***')
+
+def get_uid_from_term(term:str) -> tuple[str, str, int]:
     """
-    Based on the search term ping the NCBI SRA Database and return a list of 
+    Based on the search term ping the NCBI SRA Database and store the matching uids
+    on the E-utilities history server.
+    Returns the WebEnv, query_key and total count needed to page through the results with efetch.
     """
-    url = f"{NCBI_EUTILS_BASEURL}esearch.fcgi?db=sra&term={term}&retmax={retmax}&retstart={retstart}"
-    response = requests.get(url)
+    params = {
+        'db': 'sra',
+        'term': term,
+        'usehistory': 'y',
+        'retmax': 0,
+        'api_key': api_key
+    }
+    response = SESSION.get(f"{NCBI_EUTILS_BASEURL}esearch.fcgi", params=params)
     if response.status_code != 200:
         logging.error(f"Failed to fetch data from NCBI: {response.status_code}")
         raise Exception(f"Failed to fetch data from NCBI: {response.status_code}")
@@ -55,32 +122,28 @@ def get_uid_from_term(term:str,retmax:int=10,retstart:int=0) -> list[int]:
     """
     <eSearchResult>
 <Count>1186478</Count>
-<RetMax>10</RetMax>
+<RetMax>0</RetMax>
 <RetStart>0</RetStart>
+<QueryKey>1</QueryKey>
+<WebEnv>MCID_67b9a1f0e3b5a1234c0d5e6f</WebEnv>
 <IdList>
-<Id>37400425</Id>
-<Id>37400424</Id>
-<Id>37400423</Id>
-<Id>37400422</Id>
-<Id>37400421</Id>
-<Id>37400420</Id>
-<Id>37400419</Id>
-<Id>37400418</Id>
-<Id>37400417</Id>
-<Id>37400416</Id>
 </IdList>
 </eSearchResult>
     """
-    # parse the xml file and return a list of uids
-    root = ET.fromstring(response.text)
-    maximum_count = int(root.find('.//Count').text)
-    previous_start = retstart
-    uids = [int(uid.text) for uid in root.findall('.//Id')]
-    return uids,maximum_count,previous_start
+    # parse the xml file and return the history server handles
+    root = ET.fromstring(response.content)
+    count = root.find('.//Count')
+    webenv = root.find('.//WebEnv')
+    query_key = root.find('.//QueryKey')
+    if count is None or webenv is None or query_key is None:
+        logging.error("NCBI search response is missing Count, WebEnv or QueryKey")
+        raise Exception("NCBI search response is missing Count, WebEnv or QueryKey")
+    return webenv.text, query_key.text, int(count.text)
 
-def get_sraid_from_uid(uid_list:list[int]) -> list[str]:
+def get_sraid_from_uid(webenv:str, query_key:str, retstart:int=0, retmax:int=500) -> list[dict]:
     """
-    Based on the list of uids ping the NCBI SRA Database and return a list of sra ids.
+    Based on a search stored on the history server ping the NCBI SRA Database and return
+    the run info for uids retstart to retstart + retmax.
     This will return a XML file with parameters like
 <Row>
 <Run>SRR32410640</Run>
@@ -121,29 +184,53 @@ def get_sraid_from_uid(uid_list:list[int]) -> list[str]:
 </SraRunInfo>
     """
     # From this XML file extract create a dict of each row and return a list of dicts
-# sample url https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=sra&id=37384107,37380910&rettype=runinfo&retmode=xml
+# sample url https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=sra&WebEnv=MCID_67b9a1f0e3b5a1234c0d5e6f&query_key=1&retstart=0&retmax=500&rettype=runinfo&retmode=xml
     
-    url = f"{NCBI_EUTILS_BASEURL}efetch.fcgi?db=sra&id={','.join(map(str,uid_list))}&rettype=runinfo&retmode=xml"
-    response = requests.get(url)
+    params = {
+        'db': 'sra',
+        'WebEnv': webenv,
+        'query_key': query_key,
+        'retstart': retstart,
+        'retmax': retmax,
+        'rettype': 'runinfo',
+        'retmode': 'xml',
+        'api_key': api_key
+    }
+    response = SESSION.get(f"{NCBI_EUTILS_BASEURL}efetch.fcgi", params=params)
     if response.status_code != 200:
         logging.error(f"Failed to fetch data from NCBI: {response.status_code}")
         raise Exception(f"Failed to fetch data from NCBI: {response.status_code}")
     
-        # parse the xml file and return a list of dicts
-    root = ET.fromstring(response.text)
+    # stream-parse the raw bytes and build a dict per Row as each one closes
     run_info_list = []
-    for row in root.findall('Row'):
-        run_info = {}
-        for child in row:
-            run_info[child.tag.lower()] = child.text
-        run_info_list.append(run_info)
-    #pretty print the run_info_list
-    logging.info(f"Run info list: {json.dumps(run_info_list, indent=4)}")
+    for _, elem in ET.iterparse(io.BytesIO(response.content), events=('end',)):
+        if elem.tag == 'Row':
+            run_info = {child.tag.lower(): child.text for child in elem}
+            run_info_list.append(run_info)
+            elem.clear()
+    logging.info(f"Run info list: {len(run_info_list)} runs retrieved")
+    # Only pay for pretty printing the full list when debug output is enabled
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Run info details: %s", json.dumps(run_info_list, indent=4))
     return run_info_list
 
-def download_single_sra_file(run_info: dict, output_dir: str) -> tuple[str, bool]:
+def drop_page_cache(file_path: str):
+    """
+    Advise the kernel that the cached pages of a file are no longer needed.
+    Does nothing on platforms without posix_fadvise (e.g. Windows). This is only a hint,
+    so failures are ignored.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        with open(file_path, 'rb') as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+
+def download_single_sra_file(run_info: dict, output_dir: str, show_progress: bool = True) -> tuple[str, bool]:
     """
-    Download a single SRA file with progress tracking
+    Download a single SRA file, optionally with a console progress bar
     
     Returns:
         tuple[str, bool]: (sra_id, success_status)
@@ -159,29 +246,28 @@ def download_single_sra_file(run_info: dict, output_dir: str) -> tuple[str, bool
             logging.info(f"File {sra_file_name} already exists, skipping...")
             return sra_id, True
         
-        headers = {
-            'User-Agent': f'SRA Downloader (contact: {os.getenv("NCBI_EMAIL")})'
-        }
-        
-        # Get file size
-        response = requests.head(trace_url, headers=headers)
-        total_size = int(response.headers.get('content-length', 0))
-        
-        # Download with progress bar
-        with requests.get(trace_url, stream=True, headers=headers) as r:
+        logging.info(f"Downloading {sra_file_name}")
+        with SESSION.get(trace_url, stream=True) as r:
             r.raise_for_status()
+            # Get file size from the response headers before reading the body
+            total_size = int(r.headers.get('content-length', 0))
+            # Read straight from the raw stream in 1 MB blocks to keep per-chunk overhead low
+            r.raw.decode_content = True
             
             with open(sra_file_path, 'wb') as f:
-                with tqdm(
-                    total=total_size,
-                    unit='iB',
-                    unit_scale=True,
-                    desc=f"Downloading {sra_file_name}",
-                    leave=True
-                ) as pbar:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        size = f.write(chunk)
-                        pbar.update(size)
+                if show_progress:
+                    with tqdm(
+                        total=total_size,
+                        unit='iB',
+                        unit_scale=True,
+                        desc=f"Downloading {sra_file_name}",
+                        leave=True,
+                        mininterval=1.0
+                    ) as pbar:
+                        reader = CallbackIOWrapper(pbar.update, r.raw, 'read')
+                        shutil.copyfileobj(reader, f, length=DOWNLOAD_CHUNK_SIZE)
+                else:
+                    shutil.copyfileobj(r.raw, f, length=DOWNLOAD_CHUNK_SIZE)
         
         # Verify file size
         actual_size = os.path.getsize(sra_file_path)
@@ -224,33 +310,42 @@ def process_downloaded_file(sra_id: str, gz_file_path: str, clean_dataset_dir: s
     except Exception as e:
         logging.error(f"Error processing file {sra_id}: {str(e)}")
     finally:
-        # Clean up the temporary gz file
+        # Clean up the temporary gz file if it was not moved to the clean dataset folder
         if os.path.exists(gz_file_path):
             os.remove(gz_file_path)
     
     return False
 
-def download_and_process_parallel(run_info_list: list[dict], output_dir: str, clean_dataset_dir: str, max_workers: int = 5):
+def download_and_process_parallel(run_info_list: list[dict], output_dir: str, clean_dataset_dir: str, max_workers: int = 5, show_progress: bool = True):
     """
-    Download files in parallel and process them as they complete downloading
+    Download files in parallel and process them as they complete downloading.
+    Downloads and FastQC runs use separate pools so quality checks overlap with
+    the remaining downloads instead of running serially on the calling thread.
     """
     os.makedirs(output_dir, exist_ok=True)
     processed_files = []
     
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    with ThreadPoolExecutor(max_workers=max_workers) as dl_pool, \
+            ThreadPoolExecutor(max_workers=max_workers) as qc_pool:
         # Submit all download tasks
         future_to_sra = {
-            executor.submit(download_single_sra_file, run_info, output_dir): run_info['run']
+            dl_pool.submit(download_single_sra_file, run_info, output_dir, show_progress): run_info['run']
             for run_info in run_info_list
         }
         
-        # Process files as they complete downloading
+        # Hand files to the FastQC pool as they complete downloading
+        qc_future_to_sra = {}
         for future in as_completed(future_to_sra):
             sra_id, success = future.result()
             if success:
                 gz_file_path = os.path.join(output_dir, f"{sra_id}.fastq.gz")
-                if process_downloaded_file(sra_id, gz_file_path, clean_dataset_dir):
-                    processed_files.append(sra_id)
+                qc_future = qc_pool.submit(process_downloaded_file, sra_id, gz_file_path, clean_dataset_dir)
+                qc_future_to_sra[qc_future] = sra_id
+        
+        # Collect quality check results
+        for qc_future in as_completed(qc_future_to_sra):
+            if qc_future.result():
+                processed_files.append(qc_future_to_sra[qc_future])
                     
     return processed_files
 
@@ -268,7 +363,7 @@ def run_fastqc_and_save_in_clean_dataset_folder_if_all_params_in_summary_txt_fil
         clean_dataset_dir: Directory where clean datasets should be saved
     
     Returns:
-        bool: True if file passes quality check and is copied to clean dataset folder
+        bool: True if file passes quality check and is moved to clean dataset folder
     """
     # Create FastQC output directory
     fastqc_output_dir = os.path.join(temp_output_dir, FASTQ_TEMP_FOLDER)
@@ -276,9 +371,15 @@ def run_fastqc_and_save_in_clean_dataset_folder_if_all_params_in_summary_txt_fil
     
     try:
         # Run FastQC command
-        fastqc_cmd = f"{fastqc_path} {fastq_gz_file_path} -o {fastqc_output_dir} --extract"
-        logging.info(f"Running FastQC: {fastqc_cmd}")
-        os.system(fastqc_cmd)
+        fastqc_cmd = [fastqc_path, fastq_gz_file_path, '-o', fastqc_output_dir, '--extract']
+        logging.info(f"Running FastQC: {' '.join(fastqc_cmd)}")
+        subprocess.run(
+            fastqc_cmd,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True
+        )
 
         # Get the FastQC results directory name
         fastq_filename = os.path.basename(fastq_gz_file_path)
@@ -298,68 +399,92 @@ def run_fastqc_and_save_in_clean_dataset_folder_if_all_params_in_summary_txt_fil
                     logging.info(f"FastQC found quality issues in {fastq_filename}: {line.strip()}")
                     return False
 
-        # If no FAIL found, copy the file to clean dataset folder
+        # If no FAIL found, move the file to clean dataset folder
         os.makedirs(clean_dataset_dir, exist_ok=True)
         clean_file_path = os.path.join(clean_dataset_dir, fastq_filename)
         
-        # Use copy2 to preserve metadata
-        from shutil import copy2
-        copy2(fastq_gz_file_path, clean_file_path)
-        logging.info(f"File passed quality check and copied to clean dataset folder: {clean_file_path}")
+        # FastQC is done reading the file we're keeping, release its cached pages
+        drop_page_cache(fastq_gz_file_path)
+        
+        # Rename in place when possible, fall back to a copy across filesystems
+        try:
+            os.replace(fastq_gz_file_path, clean_file_path)
+        except OSError:
+            shutil.move(fastq_gz_file_path, clean_file_path)
+        logging.info(f"File passed quality check and moved to clean dataset folder: {clean_file_path}")
         
         return True
 
+    except subprocess.CalledProcessError as e:
+        logging.error(f"FastQC exited with code {e.returncode} on {fastq_gz_file_path}: {e.stderr.strip()}")
+        return False
     except Exception as e:
         logging.error(f"Error running FastQC on {fastq_gz_file_path}: {str(e)}")
         return False
     finally:
         # Clean up temporary FastQC output
-        import shutil
         if 'fastqc_results_dir' in locals() and os.path.exists(fastqc_results_dir):
             shutil.rmtree(fastqc_results_dir)
 
-def main(search_term: str, num_clean_datasets: int, workers: int):
+def main(search_term: str, num_clean_datasets: int, workers: int, show_progress: bool = True):
     logging.info(f"Starting download process for term: {search_term}, target: {num_clean_datasets} clean datasets")
     
     retstart = 0
     clean_datasets_count = 0
+    fetch_batch_size = 500
     batch_size = 10
+    max_query_attempts = 3
     
     # Create necessary directories
     os.makedirs(GZ_TEMP_FOLDER, exist_ok=True)
     clean_dataset_dir = os.path.join(os.path.dirname(__file__), CLEAN_DATASET_FOLDER)
     
+    # Page through the search results on the history server, searching again for
+    # fresh handles whenever a query fails (e.g. because the WebEnv expired)
+    webenv = None
+    query_failures = 0
+    
     while clean_datasets_count < num_clean_datasets:
         try:
-            # Get UIDs for the current batch
-            uids, max_count, _ = get_uid_from_term(search_term, retmax=batch_size, retstart=retstart)
+            if webenv is None:
+                webenv, query_key, max_count = get_uid_from_term(search_term)
             
-            if not uids:
-                logging.warning("No more datasets available from the search term")
+            if retstart >= max_count:
+                if retstart == 0:
+                    logging.warning("No more datasets available from the search term")
+                else:
+                    logging.warning("Reached the end of available datasets")
                 break
-                
-            # Get SRA run info for the UIDs
-            run_info_list = get_sraid_from_uid(uids)
             
-            # Download and process files in parallel
-            processed_files = download_and_process_parallel(run_info_list, GZ_TEMP_FOLDER, CLEAN_DATASET_FOLDER, max_workers=workers)
+            # Get SRA run info for the next page of search results
+            run_info_list = get_sraid_from_uid(webenv, query_key, retstart=retstart, retmax=fetch_batch_size)
+        except Exception as e:
+            query_failures += 1
+            logging.error(f"Error querying SRA database (attempt {query_failures}/{max_query_attempts}): {redact_api_key(str(e))}")
+            if query_failures >= max_query_attempts:
+                logging.error("Giving up after repeated SRA database errors")
+                break
+            webenv = None
+            time.sleep(2 ** query_failures)
+            continue
+        
+        query_failures = 0
+        retstart += fetch_batch_size
+        
+        # Download and process files in small parallel batches so we stop close to the target
+        for i in range(0, len(run_info_list), batch_size):
+            try:
+                processed_files = download_and_process_parallel(run_info_list[i:i + batch_size], GZ_TEMP_FOLDER, CLEAN_DATASET_FOLDER, max_workers=workers, show_progress=show_progress)
+            except Exception as e:
+                # Only skip the batch that failed, not the rest of the page
+                logging.error(f"Error in main processing loop: {redact_api_key(str(e))}")
+                continue
             
             clean_datasets_count += len(processed_files)
             logging.info(f"Clean datasets collected: {clean_datasets_count}/{num_clean_datasets}")
             
             if clean_datasets_count >= num_clean_datasets:
                 break
-            
-            retstart += batch_size
-            
-            # Check if we've processed all available datasets
-            if retstart >= max_count:
-                logging.warning("Reached the end of available datasets")
-                break
-                
-        except Exception as e:
-            logging.error(f"Error in main processing loop: {str(e)}")
-            continue
     
     # Clean up temporary folders
     #if os.path.exists(GZ_TEMP_FOLDER):
@@ -375,9 +500,13 @@ if __name__ == "__main__":
     parser.add_argument("--term", required=True, help="Search term for SRA database")
     parser.add_argument("--num_datasets", type=int, required=True, help="Number of clean datasets needed")
     parser.add_argument("--workers", type=int, default=3, help="Number of parallel downloads (1-8, recommended: 3-5)")
+    parser.add_argument("--log_file", default=log_filename, help="Path of the log file to write")
+    parser.add_argument("--no_progress", action="store_true", help="Disable the per-download progress bars")
     args = parser.parse_args()
     
+    setup_logging(args.log_file)
+    
     # Validate workers argument
     workers = max(1, min(8, args.workers))
     
-    main(args.term, args.num_datasets, workers)
\ No newline at end of file
+    main(args.term, args.num_datasets, workers, show_progress=not args.no_progress)
\ No newline at end of file